@@ -1,17 +1,36 @@
 import csv
 import json
 from datetime import datetime
-import ast
 import argparse
+import io
 import os
-import glob
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+from functools import lru_cache, partial
+from heapq import nlargest
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SCRIPT_DIR = os.path.dirname(__file__)
+REQUIRED_COLUMNS = ['title', 'techniques', 'subtechniques']
+_METADATA_KEY = "Rules Using Technique"
+WRITE_BUFFER_SIZE = 1 << 20
 
 def get_csv_files_from_manual():
     """Get all CSV files from manual folder."""
-    manual_dir = os.path.join(os.path.dirname(__file__), 'manual')
+    manual_dir = os.path.join(SCRIPT_DIR, 'manual')
     if not os.path.exists(manual_dir):
         raise FileNotFoundError("Manual folder not found")
-    csv_files = glob.glob(os.path.join(manual_dir, '*.csv'))
+    with os.scandir(manual_dir) as entries:
+        csv_files = [
+            entry.path for entry in entries
+            if entry.name.endswith('.csv') and not entry.name.startswith('.') and entry.is_file()
+        ]
     if not csv_files:
         raise FileNotFoundError("No CSV files found in manual folder")
     return csv_files
@@ -23,85 +42,141 @@ def get_subfolder_name(csv_path):
         return base_name.split('_')[0]
     return 'default'
 
+def get_output_directory(subfolder=None):
+    """Path of the MITRE output directory, or of a subfolder within it."""
+    base_dir = os.path.join(SCRIPT_DIR, 'MITRE')
+    if subfolder:
+        return os.path.join(base_dir, subfolder)
+    return base_dir
+
+@lru_cache(maxsize=None)
 def ensure_output_directory(subfolder=None):
     """Create MITRE output directory and subfolder if needed."""
-    base_dir = os.path.join(os.path.dirname(__file__), 'MITRE')
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
+    output_dir = get_output_directory(subfolder)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+# Serialize obj to indented JSON bytes, using orjson when available.
+# The encoder and its options are chosen once here, not on every call.
+if orjson is not None:
+    dump_json = partial(orjson.dumps, option=orjson.OPT_INDENT_2)
+else:
+    def dump_json(obj):
+        """Serialize obj to indented JSON bytes with the standard library."""
+        return json.dumps(obj, indent=2).encode()
+
+def write_layer_file(layer_filename, layer_json):
+    """Write the whole layer JSON to disk in one call."""
+    with open(layer_filename, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(dump_json(layer_json))
+
+def stream_layer_file(layer_filename, layer_json):
+    """Write layer JSON to disk one technique at a time to bound peak memory.
     
-    if subfolder:
-        subfolder_path = os.path.join(base_dir, subfolder)
-        if not os.path.exists(subfolder_path):
-            os.makedirs(subfolder_path)
-        return subfolder_path
-    return base_dir
+    layer_json["techniques"] may be any iterable. Output matches the
+    2-space indented form written by write_layer_file.
+    """
+    with open(layer_filename, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(b'{')
+        for i, (key, value) in enumerate(layer_json.items()):
+            f.write(b',\n  ' if i else b'\n  ')
+            f.write(dump_json(key) + b': ')
+            if key == 'techniques':
+                empty = True
+                for technique in value:
+                    f.write(b'[\n    ' if empty else b',\n    ')
+                    # JSON strings escape newlines, so re-indenting is safe
+                    f.write(dump_json(technique).replace(b'\n', b'\n    '))
+                    empty = False
+                f.write(b'[]' if empty else b'\n  ]')
+            else:
+                f.write(dump_json(value).replace(b'\n', b'\n  '))
+        f.write(b'\n}')
 
-def process_mitre_data(csv_path):
-    # Validate file exists
-    if not os.path.exists(csv_path):
-        raise FileNotFoundError(f"CSV file not found: {csv_path}")
-        
-    # Initialize counters
-    tactics_count = {}
-    techniques_count = {}
-    rules_with_mappings = []
+def check_required_columns(headers):
+    """Raise ValueError if any of REQUIRED_COLUMNS is missing from headers."""
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in headers]
     
-    try:
-        with open(csv_path, 'r', encoding='utf-8-sig') as f:
-            reader = csv.reader(f)
-            headers = [h.strip() for h in next(reader)]
-            
-            # Check required columns exist
-            required_columns = ['title', 'techniques', 'subtechniques']
-            missing_columns = [col for col in required_columns if col not in headers]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}\nFound columns: {headers}")
+
+def parse_csv(csv_path):
+    """Parse CSV with csv.reader and count technique and tactic coverage."""
+    tactics_count = Counter()
+    techniques_count = Counter()
+    technique_to_rules = {}
+    rules_with_mappings = 0
+    
+    with open(csv_path, 'r', encoding='utf-8-sig', buffering=65536) as f:
+        reader = csv.reader(f)
+        headers = [h.strip() for h in next(reader)]
+        check_required_columns(headers)
             
-            if missing_columns:
-                raise ValueError(f"Missing required columns: {missing_columns}\nFound columns: {headers}")
+        title_idx = headers.index('title')
+        tech_idx = headers.index('techniques')
+        subtech_idx = headers.index('subtechniques')
+        min_row_len = max(title_idx, tech_idx, subtech_idx) + 1
+        
+        # Bind bound methods to locals to skip attribute lookups in the loop
+        tc_get = techniques_count.get
+        tac_get = tactics_count.get
+        
+        # Techniques repeat across rules, so memoize per unique raw token
+        stripped_of = {}
+        base_of = {}
+        stripped_get = stripped_of.get
+        base_get = base_of.get
+        
+        for row in reader:
+            if len(row) >= min_row_len:
+                techniques = row[tech_idx].strip()
+                subtechniques = row[subtech_idx].strip()
                 
-            title_idx = headers.index('title')
-            tech_idx = headers.index('techniques')
-            subtech_idx = headers.index('subtechniques')
-            
-            for row in reader:
-                if len(row) >= max(title_idx + 1, tech_idx + 1, subtech_idx + 1):
-                    rule_name = row[title_idx].strip()
-                    techniques = row[tech_idx].strip()
-                    subtechniques = row[subtech_idx].strip()
+                # Skip empty rows before doing any other per-row work
+                if not techniques and not subtechniques:
+                    continue
                     
-                    # Skip empty rows
-                    if not techniques and not subtechniques:
-                        continue
-                        
-                    all_techniques = []
+                rule_name = row[title_idx].strip()
+                all_techniques = []
+                
+                # Process main techniques, then subtechniques
+                for raw in f"{techniques},{subtechniques}".split(','):
+                    technique = stripped_get(raw)
+                    if technique is None:
+                        technique = stripped_of[raw] = raw.strip()
+                    if technique:
+                        all_techniques.append(technique)
+                
+                if all_techniques:
+                    rules_with_mappings += 1
                     
-                    # Process main techniques
-                    if techniques:
-                        all_techniques.extend([t.strip() for t in techniques.split(',') if t.strip()])
-                        
-                    # Process subtechniques
-                    if subtechniques:
-                        all_techniques.extend([t.strip() for t in subtechniques.split(',') if t.strip()])
+                    # Count techniques and tactics (base technique of each subtechnique)
+                    for technique in all_techniques:
+                        techniques_count[technique] = tc_get(technique, 0) + 1
+                        base_technique = base_get(technique)
+                        if base_technique is None:
+                            base_technique = base_of[technique] = technique.partition('.')[0]
+                        tactics_count[base_technique] = tac_get(base_technique, 0) + 1
                     
-                    if all_techniques:
-                        rules_with_mappings.append({
-                            'name': rule_name,
-                            'techniques': all_techniques
-                        })
-                        
-                        # Count techniques
-                        for technique in all_techniques:
-                            techniques_count[technique] = techniques_count.get(technique, 0) + 1
-                            
-                            # Extract tactic from technique
-                            if '.' in technique:
-                                base_technique = technique.split('.')[0]
-                                tactics_count[base_technique] = tactics_count.get(base_technique, 0) + 1
-                            else:
-                                tactics_count[technique] = tactics_count.get(technique, 0) + 1
+                    # Index rules by technique, listing each rule once per technique
+                    for technique in dict.fromkeys(all_techniques):
+                        technique_to_rules.setdefault(technique, []).append(rule_name)
+    
+    return techniques_count, tactics_count, technique_to_rules, rules_with_mappings
+
+def process_mitre_data(csv_path, stream=True):
+    """Generate a layer file from csv_path; return its path, or None on error."""
+    # Validate file exists
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(f"CSV file not found: {csv_path}")
+    
+    try:
+        techniques_count, tactics_count, technique_to_rules, rules_with_mappings = parse_csv(csv_path)
 
         # Generate layer file
         max_score = max(techniques_count.values()) if techniques_count else 1
-        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        now = datetime.now()
+        current_time = now.strftime("%Y%m%d_%H%M%S")
         base_name = os.path.splitext(os.path.basename(csv_path))[0]
         subfolder = get_subfolder_name(csv_path)
         output_dir = ensure_output_directory(subfolder)
@@ -119,14 +194,14 @@ def process_mitre_data(csv_path):
             "metadata": [
                 {
                     "name": "generated",
-                    "value": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    "value": now.strftime("%Y-%m-%d %H:%M:%S")
                 },
                 {
                     "name": "rules_analyzed", 
-                    "value": str(len(rules_with_mappings))
+                    "value": str(rules_with_mappings)
                 }
             ],
-            "techniques": [
+            "techniques": (
                 {
                     "techniqueID": tid,
                     "score": count,
@@ -134,16 +209,13 @@ def process_mitre_data(csv_path):
                     "enabled": True,
                     "metadata": [
                         {
-                            "name": "Rules Using Technique",
-                            "value": "\n".join([
-                                rule['name'] for rule in rules_with_mappings 
-                                if tid in rule['techniques']
-                            ])
+                            "name": _METADATA_KEY,
+                            "value": "\n".join(technique_to_rules[tid])
                         }
                     ],
                     "showSubtechniques": True
                 } for tid, count in techniques_count.items()
-            ],
+            ),
             "gradient": {
                 "colors": ["#ffffff", "#ff6666"],
                 "minValue": 0,
@@ -151,25 +223,80 @@ def process_mitre_data(csv_path):
             }
         }
         
-        with open(layer_filename, 'w') as f:
-            json.dump(layer_json, f, indent=4)
+        if stream:
+            stream_layer_file(layer_filename, layer_json)
+        else:
+            layer_json["techniques"] = list(layer_json["techniques"])
+            write_layer_file(layer_filename, layer_json)
             
         print("\n=== MITRE Coverage Statistics ===")
         print(f"\nTotal Coverage:")
-        print(f"- Rules with MITRE mappings: {len(rules_with_mappings)}")
+        print(f"- Rules with MITRE mappings: {rules_with_mappings}")
         print(f"- Unique techniques covered: {len(techniques_count)}")
         print(f"- Unique tactics covered: {len(tactics_count)}")
         
-        technique_stats = dict(sorted(techniques_count.items(), key=lambda x: x[1], reverse=True))
         print("\nTop 5 techniques by implementation:")
-        for technique, count in list(technique_stats.items())[:5]:
+        for technique, count in nlargest(5, techniques_count.items(), key=itemgetter(1)):
             print(f"  • {technique}: {count} rules")
             
         print(f"\nLayer file saved as: {layer_filename}")
         print("You can visualize this layer at: https://mitre-attack.github.io/attack-navigator/")
+        return layer_filename
         
     except Exception as e:
         print(f"Error processing MITRE data: {e}")
+        return None
+
+def get_stamp_path(csv_path):
+    """Path of the sidecar stamp recording the last processed state of csv_path."""
+    base_name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(get_output_directory(get_subfolder_name(csv_path)), f"{base_name}.stamp")
+
+def get_csv_stamp(csv_path):
+    """Cheap change key for csv_path from its size and modification time."""
+    stat = os.stat(csv_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def process_manual_file(csv_file, stream=True, force=False, capture=False):
+    """Process one manual CSV and return (success, console report).
+    
+    With capture set, output is collected instead of printed so that reports
+    from parallel workers can be printed whole, in file order, by the caller.
+    Otherwise it is printed as it happens and the report is empty.
+    """
+    if not capture:
+        return _process_manual_file(csv_file, stream, force), ''
+    report = io.StringIO()
+    with redirect_stdout(report):
+        success = _process_manual_file(csv_file, stream, force)
+    return success, report.getvalue()
+
+def _process_manual_file(csv_file, stream, force):
+    """Process one manual CSV, reporting errors instead of raising.
+    
+    Files whose size and mtime match the stamp from the last successful run,
+    and whose layer file still exists, are skipped unless force is set.
+    """
+    print(f"\nProcessing {csv_file}...")
+    try:
+        stamp_path = get_stamp_path(csv_file)
+        stamp = get_csv_stamp(csv_file)
+        if not force and os.path.exists(stamp_path):
+            with open(stamp_path) as f:
+                last_stamp, _, last_layer = f.read().partition('\n')
+            if last_stamp == stamp and os.path.exists(last_layer):
+                print(f"Skipping {csv_file} (unchanged, layer: {last_layer})")
+                return True
+        
+        layer_filename = process_mitre_data(csv_file, stream)
+        if layer_filename is None:
+            return False
+        with open(stamp_path, 'w') as f:
+            f.write(f"{stamp}\n{layer_filename}")
+    except Exception as e:
+        print(f"Error processing {csv_file}: {e}")
+        return False
+    return True
 
 def main():
     parser = argparse.ArgumentParser(
@@ -186,18 +313,46 @@ def main():
         action='store_true',
         help='Process all CSV files in manual folder'
     )
+    parser.set_defaults(stream=True)
+    parser.add_argument(
+        '--no-stream',
+        dest='stream',
+        action='store_false',
+        default=argparse.SUPPRESS,  # stream=True comes from set_defaults; hides "(default: True)"
+        help='Build the whole layer in memory before writing, for debugging. Streaming is on by default.'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='With --manual, reprocess CSV files even if unchanged since the last run'
+    )
     
     args = parser.parse_args()
     
     try:
         if args.manual:
             csv_files = get_csv_files_from_manual()
-            for csv_file in csv_files:
-                print(f"\nProcessing {csv_file}...")
-                process_mitre_data(csv_file)
+            parallel = len(csv_files) > 1
+            process_file = partial(process_manual_file, stream=args.stream, force=args.force, capture=parallel)
+            results = []
+            if parallel:
+                pool = ProcessPoolExecutor(max_workers=min(len(csv_files), os.cpu_count() or 1))
+            else:
+                # A single file is processed in-process to skip pool startup
+                pool = nullcontext()
+            with pool as executor:
+                mapper = executor.map if executor is not None else map
+                # map yields in csv_files order, so each report prints whole, in order
+                for success, report in mapper(process_file, csv_files):
+                    print(report, end='')
+                    results.append(success)
+            if not all(results):
+                print(f"\n{results.count(False)} of {len(csv_files)} files failed")
+                return 1
             print("\nAll files processed successfully")
         else:
-            process_mitre_data(args.file)
+            if process_mitre_data(args.file, args.stream) is None:
+                return 1
     except Exception as e:
         print(f"Error: {e}")
         return 1